@@ -3,12 +3,19 @@ import torchvision.transforms as transforms
 import cv2
 from torchvision import models
 import numpy as np
+import sys
+sys.path.append('../')
+from utils import use_half
 
 class CourtLineDetector:
     def __init__(self, model_path):
         self.model = models.resnet50(pretrained=True)
         self.model.fc = torch.nn.Linear(self.model.fc.in_features, 14*2) 
         self.model.load_state_dict(torch.load(model_path, map_location='cpu'))
+        # Run on the GPU when there is one, in FP16 if it has tensor cores (see use_half)
+        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.half = use_half()
+        self.model.to(self.device)
         self.transform = transforms.Compose([
             transforms.ToPILImage(),
             transforms.Resize((224, 224)),
@@ -20,28 +27,20 @@ class CourtLineDetector:
 
     
         image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        image_tensor = self.transform(image_rgb).unsqueeze(0)
-        with torch.no_grad():
+        image_tensor = self.transform(image_rgb).unsqueeze(0).to(self.device)
+        with torch.no_grad(), torch.autocast(self.device, dtype=torch.float16, enabled=self.half):
             outputs = self.model(image_tensor)
-        keypoints = outputs.squeeze().cpu().numpy()
+        # Back to FP32 before scaling to image coordinates
+        # (14,2) float32 array of (x,y) keypoints, scaled from the 224x224 model input to the image
+        keypoints = outputs.squeeze().float().cpu().numpy().reshape(-1, 2)
         original_h, original_w = image.shape[:2]
-        keypoints[::2] *= original_w / 224.0
-        keypoints[1::2] *= original_h / 224.0
+        keypoints *= (original_w / 224.0, original_h / 224.0)
 
         return keypoints
 
     def draw_keypoints(self, image, keypoints):
         # Plot keypoints on the image
-        for i in range(0, len(keypoints), 2):
-            x = int(keypoints[i])
-            y = int(keypoints[i+1])
-            cv2.putText(image, str(i//2), (x, y-10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 2)
+        for i, (x, y) in enumerate(keypoints.astype(int).tolist()):
+            cv2.putText(image, str(i), (x, y-10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 2)
             cv2.circle(image, (x, y), 5, (0, 0, 255), -1)
         return image
-    
-    def draw_keypoints_on_video(self, video_frames, keypoints):
-        output_video_frames = []
-        for frame in video_frames:
-            frame = self.draw_keypoints(frame, keypoints)
-            output_video_frames.append(frame)
-        return output_video_frames
\ No newline at end of file
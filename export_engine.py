@@ -0,0 +1,21 @@
+import argparse
+from ultralytics import YOLO
+from utils import export_yolo_engine, write_calibration_data
+
+# Export the detectors to TensorRT engines ahead of time, so the first run doesn't pay for it.
+# Usage: python export_engine.py [batch_size] [--int8]; match the batch size the engines will be used with
+parser = argparse.ArgumentParser()
+parser.add_argument('batch_size', type=int, nargs='?', default=16)
+# INT8 ball model, calibrated on frames of the input video. Check its detections on another clip against the
+# FP16 engine before using it: the ball is a few pixels wide and loses the most from quantization
+parser.add_argument('--int8', action='store_true', help='INT8 engine for the ball model')
+parser.add_argument('--calibration-video', default='input_videos/input_video.mp4')
+args = parser.parse_args()
+
+print(export_yolo_engine('yolov8x', args.batch_size))
+
+ball_model_path = 'models/yolo5_last.pt'
+int8_data = None
+if args.int8:
+    int8_data = write_calibration_data(args.calibration_video, YOLO(ball_model_path).names, 'runs/calibration')
+print(export_yolo_engine(ball_model_path, args.batch_size, int8_data=int8_data))
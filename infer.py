@@ -0,0 +1,224 @@
+import argparse
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from multiprocessing.connection import Listener, Client
+import multiprocessing
+import cv2
+import numpy as np
+import torch
+from utils import read_video, save_video, iter_batches, load_yolo_model, get_yolo_engine, use_half, get_ious
+
+# YOLO on a video, with an annotated copy written out.
+# Usage: python infer.py [VIDEO] [--task detect|track] [--model PATH]
+#        python infer.py --serve   keeps the models loaded between jobs; later calls are sent to it
+
+# Frames per forward pass; the same as main.py, whose engines are built for batches of up to 16
+BATCH_SIZE = 16
+# A track that starts a chunk continues the previous chunk's track it overlaps by more than this
+STITCH_IOU_THRESHOLD = 0.5
+# Unix socket of the persistent worker started with --serve, in a directory only this user can access
+RUNTIME_DIR = os.environ.get('XDG_RUNTIME_DIR') or os.path.join(tempfile.gettempdir(), f'yolo-{os.getuid()}')
+SOCKET_PATH = os.path.join(RUNTIME_DIR, 'yolo.sock')
+# Model of each task when --model is not given: the players are tracked, the ball is detected
+DEFAULT_MODELS = {
+    'track': 'yolov8x',
+    'detect': 'models/yolo5_last.pt',
+}
+
+def run_model(model, frames, task):
+    # The video is fed to the model in batches instead of frame by frame; persist keeps the track ids across batches.
+    # stream=True hands out each Results as it is postprocessed instead of building a list per batch
+    half = use_half()
+    for batch in iter_batches(frames, BATCH_SIZE):
+        if task == 'track':
+            yield from model.track(batch, conf=0.2, persist=True, half=half, stream=True, verbose=False)
+        else:
+            yield from model.predict(batch, conf=0.2, half=half, stream=True, verbose=False)
+
+def reset_tracks(model):
+    # A model kept between videos would otherwise continue the tracks of the last one
+    for tracker in getattr(model.predictor, 'trackers', []):
+        tracker.reset()
+
+def init_chunk_worker(gpu_ids):
+    # Every worker process takes its own GPU from the queue before anything in it initializes CUDA, so all the chunks
+    # it runs (a worker whose chunk finished early may get another one) stay on that GPU
+    gpu_id = gpu_ids.get()
+    if gpu_id is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(gpu_id)
+
+def run_chunk(model_path, video_path, task, start, end):
+    model = load_yolo_model(model_path, BATCH_SIZE)
+    frames = islice(read_video(video_path, start=start), end - start)
+    # Only the (N,6) [x1,y1,x2,y2,conf,cls] or tracked (N,7) [x1,y1,x2,y2,id,conf,cls] boxes go back to the main process
+    return model.names, [result.boxes.data.cpu().numpy() for result in run_model(model, frames, task)]
+
+def stitch_track_ids(chunks):
+    # Every chunk is tracked from scratch, so its ids restart at 1. A track in the first frame of a chunk keeps the id
+    # of the box it overlaps most in the last frame of the previous chunk, if both frames have tracks; every other
+    # track gets a new id. Returns new box arrays, the chunks are left as they are.
+    # Frames without any track keep their untracked (N,6) boxes
+    next_id = 1
+    last_boxes = np.empty((0, 7))
+    stitched = []
+    for chunk in chunks:
+        chunk = [boxes.copy() for boxes in chunk]
+        id_map = {}
+        if chunk and chunk[0].shape[1] == 7 and last_boxes.shape[1] == 7:
+            ious = get_ious(chunk[0][:, :4], last_boxes[:, :4])
+            # Highest overlaps first, every track is linked at most once
+            for i, j in zip(*np.unravel_index(np.argsort(-ious, axis=None), ious.shape)):
+                if ious[i, j] <= STITCH_IOU_THRESHOLD:
+                    break
+                if chunk[0][i, 4] not in id_map and last_boxes[j, 4] not in id_map.values():
+                    id_map[chunk[0][i, 4]] = last_boxes[j, 4]
+        for boxes in chunk:
+            if boxes.shape[1] != 7:
+                continue
+            for box in boxes:
+                if box[4] not in id_map:
+                    id_map[box[4]] = next_id
+                    next_id += 1
+                box[4] = id_map[box[4]]
+        if chunk:
+            last_boxes = chunk[-1]
+        stitched.append(chunk)
+    return stitched
+
+def run_model_chunks(model_path, video_path, task, num_chunks):
+    # Long videos are split into num_chunks parts along time, run in parallel processes spread over the GPUs
+    # (several processes share a GPU when there are more chunks than GPUs), and their track ids stitched together.
+    # Yields a Results per frame like run_model
+    from ultralytics.engine.results import Results
+
+    cap = cv2.VideoCapture(video_path)
+    number_of_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    bounds = np.linspace(0, number_of_frames, num_chunks + 1).astype(int).tolist()
+    # The frame count is only an estimate for some containers, the last chunk runs to the end of the video
+    bounds[-1] = 2**31
+    num_gpus = torch.cuda.device_count()
+    # Export the engine once here, rather than in every worker at the same time
+    model_path = get_yolo_engine(model_path, BATCH_SIZE)
+
+    ctx = multiprocessing.get_context('spawn')
+    gpu_ids = ctx.Queue()
+    for i in range(num_chunks):
+        gpu_ids.put(i % num_gpus if num_gpus else None)
+    with ProcessPoolExecutor(num_chunks, mp_context=ctx, initializer=init_chunk_worker, initargs=(gpu_ids,)) as executor:
+        futures = [executor.submit(run_chunk, model_path, video_path, task, start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+        chunks = [future.result() for future in futures]
+    names = chunks[0][0]
+    chunks = [chunk for _, chunk in chunks]
+    if task == 'track':
+        chunks = stitch_track_ids(chunks)
+    boxes = [box for chunk in chunks for box in chunk]
+
+    for frame, frame_boxes in zip(read_video(video_path), boxes):
+        yield Results(frame, path=video_path, names=names, boxes=torch.from_numpy(frame_boxes))
+
+def annotate(results, verbose):
+    for result in results:
+        if verbose:
+            print("boxes:")
+            for box in result.boxes:
+                print(box)
+        yield result.plot()
+
+def infer_video(model, video_path, task, output_path, verbose=False):
+    if task == 'track':
+        reset_tracks(model)
+    save_video(annotate(run_model(model, read_video(video_path), task), verbose), output_path)
+    return output_path
+
+def serve(socket_path):
+    # Persistent worker: every model it loads stays loaded (TensorRT engine deserialized, CUDA context up), so only
+    # the first job with a model pays for it. Models are kept per task, as tracking registers callbacks on a model
+    # that would track detect jobs too. Jobs run one at a time; they arrive as JSON, never as pickles
+    models = {}
+    if os.path.exists(socket_path):
+        try:
+            Client(socket_path, family='AF_UNIX').close()
+        except ConnectionRefusedError:
+            # Left behind by a worker that is gone
+            os.remove(socket_path)
+        else:
+            raise SystemExit(f"An inference server is already running on {socket_path}")
+    socket_dir = os.path.dirname(socket_path)
+    os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+    if os.stat(socket_dir).st_uid != os.getuid():
+        raise SystemExit(f"{socket_dir} belongs to another user")
+    # Created accessible to this user only, not opened up between bind and a chmod
+    old_umask = os.umask(0o177)
+    try:
+        listener = Listener(socket_path, family='AF_UNIX')
+    finally:
+        os.umask(old_umask)
+    with listener:
+        print(f"Serving on {socket_path}")
+        while True:
+            with listener.accept() as conn:
+                try:
+                    job = json.loads(conn.recv_bytes())
+                    key = (job['model'], job['task'])
+                    if key not in models:
+                        models[key] = load_yolo_model(job['model'], BATCH_SIZE)
+                    output_path = infer_video(models[key], job['video'], job['task'], job['output'], job['verbose'])
+                    reply = {'output': output_path}
+                except Exception as e:
+                    reply = {'error': repr(e)}
+                try:
+                    conn.send_bytes(json.dumps(reply).encode())
+                except OSError:
+                    # The client went away, keep serving the others
+                    pass
+
+def submit(job, socket_path):
+    # Runs the job on the worker started with --serve and returns the path of the annotated video
+    with Client(socket_path, family='AF_UNIX') as conn:
+        conn.send_bytes(json.dumps(job).encode())
+        reply = json.loads(conn.recv_bytes())
+    if 'error' in reply:
+        raise RuntimeError(f"Inference server failed: {reply['error']}")
+    return reply['output']
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('video', nargs='?', default='input_videos/input_video.mp4')
+    parser.add_argument('--task', choices=['detect', 'track'], default='track')
+    parser.add_argument('--model', help='weights or engine; by default yolov8x to track, the ball model to detect')
+    parser.add_argument('--output', help='annotated video, runs/<video>_<task>.avi by default')
+    # Printing every box formats its tensors and costs more than the detection on long videos, so it is off by default
+    parser.add_argument('--verbose', action='store_true', help='print the boxes of every frame')
+    # Each chunk loads its own model, so chunked runs never go through the --serve worker
+    parser.add_argument('--chunks', type=int, default=1, help='split the video into this many parts run in parallel, spread over the GPUs')
+    parser.add_argument('--serve', action='store_true', help='keep the models loaded and run the jobs sent to the socket')
+    parser.add_argument('--socket', default=SOCKET_PATH)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.socket)
+    else:
+        model_path = args.model or DEFAULT_MODELS[args.task]
+        output_path = args.output or os.path.join('runs', f"{os.path.splitext(os.path.basename(args.video))[0]}_{args.task}.avi")
+        # The worker may run in another directory
+        job = {
+            'video': os.path.abspath(args.video),
+            'task': args.task,
+            'model': os.path.abspath(model_path) if os.path.exists(model_path) else model_path,
+            'output': os.path.abspath(output_path),
+            'verbose': args.verbose,
+        }
+
+        if args.chunks > 1:
+            save_video(annotate(run_model_chunks(job['model'], job['video'], args.task, args.chunks), args.verbose), job['output'])
+        else:
+            try:
+                print(submit(job, args.socket))
+            except (FileNotFoundError, ConnectionRefusedError):
+                # No worker running: load the model here. TensorRT engine on the GPU, exported on first use (see export_engine.py)
+                model = load_yolo_model(job['model'], BATCH_SIZE)
+                print(infer_video(model, job['video'], args.task, job['output'], args.verbose))
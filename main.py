@@ -1,148 +1,271 @@
-from utils import (read_video, 
-                   save_video,
-                   measure_distance,
-                   draw_player_stats,
-                   convert_pixel_distance_to_meters
+import os
+# Load CUDA kernels on first use instead of all of cuBLAS/cuDNN at context creation.
+# Default on Linux since CUDA 12.2, set explicitly for older drivers; must happen before torch is imported.
+os.environ.setdefault("CUDA_MODULE_LOADING", "LAZY")
+
+from utils import (read_video,
+                   process_video_threaded,
+                   draw_player_stats_on_frame,
+                   get_track_bboxes,
+                   measure_distance_sq,
+                   Scale,
+                   iter_queue,
+                   put_item,
+                   iter_batches,
+                   run_stages,
+                   save_detections_stub,
+                   get_yolo_engine
                    )
 import constants
 from trackers import PlayerTracker,BallTracker
 from court_line_detector import CourtLineDetector
 from mini_court import MiniCourt
-import cv2
+import multiprocessing
+import threading
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
-from copy import deepcopy
+import torch
+
+# Frames buffered between two pipeline stages
+QUEUE_SIZE = 32
+# Frames per YOLO forward pass
+DETECT_BATCH_SIZE = 16
+# Mean absolute pixel difference below which a frame reuses the previous detection; None runs YOLO on every frame
+STATIC_FRAME_THRESHOLD = None
+
+
+def _new_cuda_stream():
+    # Separate stream per detection stage so the player and ball kernels can overlap on the GPU; None keeps the default stream
+    return torch.cuda.Stream() if torch.cuda.is_available() else None
+
+def _init_detect_worker(tracker_cls, model_path, batch_size, static_threshold, num_threads, warmup_frame):
+    global _worker_tracker, _worker_stream
+    torch.set_num_threads(num_threads)
+    torch.backends.cudnn.benchmark = True
+    _worker_tracker = tracker_cls(model_path, batch_size=batch_size, static_threshold=static_threshold)
+    _worker_stream = _new_cuda_stream()
+    if warmup_frame is not None:
+        with torch.cuda.stream(_worker_stream):
+            _worker_tracker.warmup(warmup_frame)
+
+def _detect_chunk(frames):
+    # Chunks reach the workers out of order, so the first frame of a chunk is always detected
+    _worker_tracker.last_thumbnail = None
+    with torch.cuda.stream(_worker_stream):
+        return _worker_tracker.detect_frames(frames, read_from_stub=False)
+
+def _num_threads(workers):
+    # Half the cores go to the main process (player tracker, court model), the rest are split between the ball workers
+    return max(1, (os.cpu_count() or 2) // 2 // workers)
+
+def parallel_detect(frames, model_path, chunk_size=64, workers=4, tracker_cls=BallTracker, batch_size=16, static_threshold=None, warmup_frame=None):
+    # Every worker loads its own model and runs its chunks independently on the shared GPU.
+    # Only use this for stateless detectors: the player tracker keeps track ids across frames.
+    # The engine is exported here once, not by every worker at the same time
+    model_path = get_yolo_engine(model_path, batch_size)
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(workers, initializer=_init_detect_worker, initargs=(tracker_cls, model_path, batch_size, static_threshold, _num_threads(workers), warmup_frame)) as pool:
+        chunk_detections = pool.imap(_detect_chunk, iter_batches(frames, chunk_size))
+        return [detection for chunk in chunk_detections for detection in chunk]
+
+
+def _last_value(values, mask):
+    # Latest value of each column where mask is set, carried forward; 0 before the first one
+    return pd.DataFrame(np.where(mask, values, np.nan)).ffill().fillna(0).to_numpy()
+
+def _safe_divide(numerator, denominator):
+    # 0 instead of nan/inf while nothing has been counted yet
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator, dtype=float), where=denominator>0)
+
+
+def stage_decode(video_path, frame_queues, stop):
+    # Already on its own thread, feeding the detection stages through their queues.
+    # stop is set when a detection stage fails (see run_stages), so the other stages give up instead of blocking
+    for frame in read_video(video_path, prefetch=0):
+        for frame_queue in frame_queues:
+            put_item(frame_queue, frame, stop)
+    for frame_queue in frame_queues:
+        put_item(frame_queue, None, stop)
+
+def stage_detect_player(player_tracker, frame_queue, player_detections, stub_path, stop):
+    with torch.cuda.stream(_new_cuda_stream()):
+        player_detections.extend(player_tracker.detect_frames(iter_queue(frame_queue, stop), stub_path=stub_path))
+
+def stage_detect_ball(ball_model_path, frame_queue, ball_detections, stub_path, first_frame, stop):
+    # The workers warm up on the first frame while the queue fills
+    ball_detections.extend(parallel_detect(iter_queue(frame_queue, stop), ball_model_path, batch_size=DETECT_BATCH_SIZE, static_threshold=STATIC_FRAME_THRESHOLD, warmup_frame=first_frame))
+
+    save_detections_stub(ball_detections, stub_path)
+
+def stage_court(court_model_path, first_frame):
+    court_line_detector = CourtLineDetector(court_model_path)
+    court_keypoints = court_line_detector.predict(first_frame)
+    return court_line_detector, court_keypoints
 
 
 def main():
-    # Read Video
     input_video_path = "input_videos/input_video.mp4"
-    video_frames = read_video(input_video_path)
-
-    # Detect Players and Ball
-    player_tracker = PlayerTracker(model_path='yolov8x')
-    ball_tracker = BallTracker(model_path='models/yolo5_last.pt')
-
-    player_detections = player_tracker.detect_frames(video_frames,
-                                                     read_from_stub=True,
-                                                     stub_path="tracker_stubs/player_detections.pkl"
-                                                     )
-    ball_detections = ball_tracker.detect_frames(video_frames,
-                                                     read_from_stub=True,
-                                                     stub_path="tracker_stubs/ball_detections.pkl"
-                                                     )
-    ball_detections = ball_tracker.interpolate_ball_positions(ball_detections)
-    
-    
-    # Court Line Detector model
+    output_video_path = "output_videos/output_video.avi"
+
+    # The other half of the cores is left for the ball detection workers
+    torch.set_num_threads(max(1, (os.cpu_count() or 2) // 2))
+    # Every frame of a video reaches the models at the same shape, so let cuDNN pick the fastest kernels for it once
+    torch.backends.cudnn.benchmark = True
+
+    # Court Line Detector model and MiniCourt only need the first frame, so they run while the players and ball are detected
     court_model_path = "models/keypoints_model.pth"
-    court_line_detector = CourtLineDetector(court_model_path)
-    court_keypoints = court_line_detector.predict(video_frames[0])
+    first_frame = next(read_video(input_video_path, prefetch=0))
+    executor = ThreadPoolExecutor(max_workers=2)
+    court_future = executor.submit(stage_court, court_model_path, first_frame)
+    mini_court_future = executor.submit(MiniCourt, first_frame)
+
+    # Detect Players and Ball; the trackers only load their models (and export the engines) if they detect
+    ball_model_path = 'models/yolo5_last.pt'
+    player_tracker = PlayerTracker(model_path='yolov8x', batch_size=DETECT_BATCH_SIZE, static_threshold=STATIC_FRAME_THRESHOLD)
+    ball_tracker = BallTracker(model_path=ball_model_path, batch_size=DETECT_BATCH_SIZE, static_threshold=STATIC_FRAME_THRESHOLD)
+
+    # Stubs are loaded directly; missing ones are detected while the video is decoded
+    player_stub_path = "tracker_stubs/player_detections.npz"
+    ball_stub_path = "tracker_stubs/ball_detections.npz"
+    frame_queues = []
+    detect_stages = []
+    stop = threading.Event()
+    if os.path.exists(player_stub_path):
+        player_detections = player_tracker.detect_frames([], read_from_stub=True, stub_path=player_stub_path)
+    else:
+        player_detections = []
+        player_queue = Queue(maxsize=QUEUE_SIZE)
+        frame_queues.append(player_queue)
+        detect_stages.append((stage_detect_player, (player_tracker, player_queue, player_detections, player_stub_path, stop)))
+        # Warm the player model up next to the court model, before the video is decoded
+        executor.submit(player_tracker.warmup, first_frame).result()
+
+    if os.path.exists(ball_stub_path):
+        ball_detections = ball_tracker.detect_frames([], read_from_stub=True, stub_path=ball_stub_path)
+    else:
+        ball_detections = []
+        ball_queue = Queue(maxsize=QUEUE_SIZE)
+        frame_queues.append(ball_queue)
+        detect_stages.append((stage_detect_ball, (ball_model_path, ball_queue, ball_detections, ball_stub_path, first_frame, stop)))
+
+    if detect_stages:
+        run_stages((stage_decode, (input_video_path, frame_queues, stop)), *detect_stages, stop=stop)
+    ball_detections = ball_tracker.interpolate_ball_positions(ball_detections)
+    number_of_frames = len(ball_detections)
+
+    court_line_detector, court_keypoints = court_future.result()
+    mini_court = mini_court_future.result()
+    executor.shutdown()
 
     # choose players
     player_detections = player_tracker.choose_and_filter_players(court_keypoints, player_detections)
 
-    # MiniCourt
-    mini_court = MiniCourt(video_frames[0]) 
-
     # Detect ball shots
     ball_shot_frames= ball_tracker.get_ball_shot_frames(ball_detections)
 
-    # Convert positions to mini court positions
-    player_mini_court_detections, ball_mini_court_detections = mini_court.convert_bounding_boxes_to_mini_court_coordinates(player_detections, 
-                                                                                                          ball_detections,
-                                                                                                          court_keypoints)
-
-    player_stats_data = [{
-        'frame_num':0,
-        'player_1_number_of_shots':0,
-        'player_1_total_shot_speed':0,
-        'player_1_last_shot_speed':0,
-        'player_1_total_player_speed':0,
-        'player_1_last_player_speed':0,
-
-        'player_2_number_of_shots':0,
-        'player_2_total_shot_speed':0,
-        'player_2_last_shot_speed':0,
-        'player_2_total_player_speed':0,
-        'player_2_last_player_speed':0,
-    } ]
-    
-    for ball_shot_ind in range(len(ball_shot_frames)-1):
-        start_frame = ball_shot_frames[ball_shot_ind]
-        end_frame = ball_shot_frames[ball_shot_ind+1]
-        ball_shot_time_in_seconds = (end_frame-start_frame)/24 # 24fps
-
-        # Get distance covered by the ball
-        distance_covered_by_ball_pixels = measure_distance(ball_mini_court_detections[start_frame][1],
-                                                           ball_mini_court_detections[end_frame][1])
-        distance_covered_by_ball_meters = convert_pixel_distance_to_meters( distance_covered_by_ball_pixels,
-                                                                           constants.DOUBLE_LINE_WIDTH,
-                                                                           mini_court.get_width_of_mini_court()
-                                                                           ) 
-
-        # Speed of the ball shot in km/h
-        speed_of_ball_shot = distance_covered_by_ball_meters/ball_shot_time_in_seconds * 3.6
-
-        # player who the ball
-        player_positions = player_mini_court_detections[start_frame]
-        player_shot_ball = min( player_positions.keys(), key=lambda player_id: measure_distance(player_positions[player_id],
-                                                                                                 ball_mini_court_detections[start_frame][1]))
-
-        # opponent player speed
-        opponent_player_id = 1 if player_shot_ball == 2 else 2
-        distance_covered_by_opponent_pixels = measure_distance(player_mini_court_detections[start_frame][opponent_player_id],
-                                                                player_mini_court_detections[end_frame][opponent_player_id])
-        distance_covered_by_opponent_meters = convert_pixel_distance_to_meters( distance_covered_by_opponent_pixels,
-                                                                           constants.DOUBLE_LINE_WIDTH,
-                                                                           mini_court.get_width_of_mini_court()
-                                                                           ) 
-
-        speed_of_opponent = distance_covered_by_opponent_meters/ball_shot_time_in_seconds * 3.6
-
-        current_player_stats= deepcopy(player_stats_data[-1])
-        current_player_stats['frame_num'] = start_frame
-        current_player_stats[f'player_{player_shot_ball}_number_of_shots'] += 1
-        current_player_stats[f'player_{player_shot_ball}_total_shot_speed'] += speed_of_ball_shot
-        current_player_stats[f'player_{player_shot_ball}_last_shot_speed'] = speed_of_ball_shot
-
-        current_player_stats[f'player_{opponent_player_id}_total_player_speed'] += speed_of_opponent
-        current_player_stats[f'player_{opponent_player_id}_last_player_speed'] = speed_of_opponent
-
-        player_stats_data.append(current_player_stats)
-
-    player_stats_data_df = pd.DataFrame(player_stats_data)
-    frames_df = pd.DataFrame({'frame_num': list(range(len(video_frames)))})
-    player_stats_data_df = pd.merge(frames_df, player_stats_data_df, on='frame_num', how='left')
-    player_stats_data_df = player_stats_data_df.ffill()
-
-    player_stats_data_df['player_1_average_shot_speed'] = player_stats_data_df['player_1_total_shot_speed']/player_stats_data_df['player_1_number_of_shots']
-    player_stats_data_df['player_2_average_shot_speed'] = player_stats_data_df['player_2_total_shot_speed']/player_stats_data_df['player_2_number_of_shots']
-    player_stats_data_df['player_1_average_player_speed'] = player_stats_data_df['player_1_total_player_speed']/player_stats_data_df['player_2_number_of_shots']
-    player_stats_data_df['player_2_average_player_speed'] = player_stats_data_df['player_2_total_player_speed']/player_stats_data_df['player_1_number_of_shots']
+    # Per-player (F,4) box arrays, indexed by frame number
+    player_bboxes = {player_id: get_track_bboxes(player_detections, player_id) for player_id in sorted(player_detections[0])}
+
+    # Convert positions to mini court positions: players (F,2,2) with player 1 first, ball (F,2)
+    players_xy, ball_xy = mini_court.convert_bounding_boxes_to_mini_court_coordinates(player_bboxes, 
+                                                                                      ball_detections,
+                                                                                      court_keypoints)
+
+    # The mini court is drawn to scale: its width in pixels is the doubles court width
+    mini_court_scale = Scale(constants.DOUBLE_LINE_WIDTH, mini_court.get_width_of_mini_court())
+
+    start_frames = np.array(ball_shot_frames[:-1], dtype=int)
+    end_frames = np.array(ball_shot_frames[1:], dtype=int)
+    ball_shot_time_in_seconds = (end_frames-start_frames)/24 # 24fps
+
+    # Get distance covered by the ball in every shot
+    ball_segments = ball_xy[end_frames] - ball_xy[start_frames]
+    distance_covered_by_ball_pixels = np.sqrt((ball_segments*ball_segments).sum(1))
+    distance_covered_by_ball_meters = mini_court_scale.to_meters(distance_covered_by_ball_pixels)
+
+    # Speed of the ball shots in km/h
+    speed_of_ball_shot = distance_covered_by_ball_meters/ball_shot_time_in_seconds * 3.6
+
+    # player who the ball: the closest one to the ball when the shot starts (squared distances give the same argmin)
+    player_shot_ball = np.argmin(measure_distance_sq(players_xy[start_frames], ball_xy[start_frames][:, None, :]), axis=1) + 1
+    opponent_player_id = 3 - player_shot_ball
+
+    # opponent player speed
+    player_segments = players_xy[end_frames] - players_xy[start_frames]
+    distance_covered_by_players_pixels = np.sqrt((player_segments*player_segments).sum(2))
+    distance_covered_by_opponent_pixels = distance_covered_by_players_pixels[np.arange(len(start_frames)), opponent_player_id-1]
+    distance_covered_by_opponent_meters = mini_court_scale.to_meters(distance_covered_by_opponent_pixels)
+
+    speed_of_opponent = distance_covered_by_opponent_meters/ball_shot_time_in_seconds * 3.6
+
+    # Per-shot deltas with one column per player; row 0 is the all-zero state at frame 0
+    shot_rows = np.arange(1, len(start_frames)+1)
+    shot_by_player = np.zeros((len(start_frames)+1, 2), dtype=bool)
+    shot_by_player[shot_rows, player_shot_ball-1] = True
+    player_is_opponent = shot_by_player[:, ::-1]
+
+    shot_speed_delta = np.zeros((len(start_frames)+1, 2))
+    shot_speed_delta[shot_rows, player_shot_ball-1] = speed_of_ball_shot
+    player_speed_delta = np.zeros((len(start_frames)+1, 2))
+    player_speed_delta[shot_rows, opponent_player_id-1] = speed_of_opponent
+
+    player_stats = {
+        'number_of_shots': np.cumsum(shot_by_player, axis=0, dtype=np.int32),
+        'total_shot_speed': np.cumsum(shot_speed_delta, axis=0),
+        'last_shot_speed': _last_value(shot_speed_delta, shot_by_player),
+        'total_player_speed': np.cumsum(player_speed_delta, axis=0),
+        'last_player_speed': _last_value(player_speed_delta, player_is_opponent),
+    }
+
+    # Carry the stats of the last shot forward to every frame: row of the latest shot that started at or before each frame
+    stats_frame_nums = np.concatenate([[0], start_frames])
+    frame_rows = np.searchsorted(stats_frame_nums, np.arange(number_of_frames), side='right') - 1
+    player_stats = {stat: values[frame_rows] for stat, values in player_stats.items()}
+
+    # Player speed is measured while the opponent's shot travels, so it is averaged over the opponent's shots
+    number_of_shots = player_stats['number_of_shots']
+    player_stats['average_shot_speed'] = _safe_divide(player_stats['total_shot_speed'], number_of_shots)
+    player_stats['average_player_speed'] = _safe_divide(player_stats['total_player_speed'], number_of_shots[:, ::-1])
+
+    player_stats_data_df = pd.DataFrame({
+        'frame_num': np.arange(number_of_frames, dtype=np.int32),
+        **{f'player_{player_id}_{stat}': values[:, player_id-1] for player_id in (1, 2) for stat, values in player_stats.items()}
+    }, copy=False)
 
 
 
     # Draw output
-    ## Draw Player Bounding Boxes
-    output_video_frames= player_tracker.draw_bboxes(video_frames, player_detections)
-    output_video_frames= ball_tracker.draw_bboxes(output_video_frames, ball_detections)
+    player_stats_rows = player_stats_data_df.to_dict('records')
+
+    # Boxes are cut to whole pixels once for the whole video: (F,P,4) players and (F,4) ball, nan rows are skipped
+    player_ids = np.array(list(player_bboxes.keys()))
+    all_player_bboxes = np.stack(list(player_bboxes.values()), axis=1)
+    player_drawn = ~np.isnan(all_player_bboxes[:,:,0])
+    all_player_bboxes = np.nan_to_num(all_player_bboxes).astype(np.int32)
+    ball_drawn = ~np.isnan(ball_detections[:,0])
+    all_ball_bboxes = np.nan_to_num(ball_detections).astype(np.int32)
 
-    ## Draw court Keypoints
-    output_video_frames  = court_line_detector.draw_keypoints_on_video(output_video_frames, court_keypoints)
+    def draw_frame(frame_num, frame):
+        ## Draw Player Bounding Boxes
+        drawn = player_drawn[frame_num]
+        frame = player_tracker.draw_bboxes_on_frame(frame, player_ids[drawn].tolist(), all_player_bboxes[frame_num][drawn])
+        if ball_drawn[frame_num]:
+            frame = ball_tracker.draw_bbox_on_frame(frame, all_ball_bboxes[frame_num])
 
-    # Draw Mini Court
-    output_video_frames = mini_court.draw_mini_court(output_video_frames)
-    output_video_frames = mini_court.draw_points_on_mini_court(output_video_frames,player_mini_court_detections)
-    output_video_frames = mini_court.draw_points_on_mini_court(output_video_frames,ball_mini_court_detections, color=(0,255,255))    
+        ## Draw court Keypoints
+        frame = court_line_detector.draw_keypoints(frame, court_keypoints)
 
-    # Draw Player Stats
-    output_video_frames = draw_player_stats(output_video_frames,player_stats_data_df)
+        # Draw Mini Court
+        frame = mini_court.render(frame, players_xy[frame_num], ball_xy[frame_num])
 
-    ## Draw frame number on top left corner
-    for i, frame in enumerate(output_video_frames):
-        cv2.putText(frame, f"Frame: {i}",(10,30),cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+        # Draw Player Stats and frame number
+        frame = draw_player_stats_on_frame(frame, player_stats_rows[frame_num])
+        return frame
 
-    save_video(output_video_frames, "output_videos/output_video.avi")
+    # Decode, draw and encode run concurrently so only a few frames are in memory at once
+    process_video_threaded(input_video_path, output_video_path, draw_frame, prefetch=QUEUE_SIZE)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,20 +1,74 @@
 import cv2
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import sys
 sys.path.append('../')
 import constants
 from utils import (
     convert_meters_to_pixel_distance,
-    convert_pixel_distance_to_meters,
-    get_foot_position,
-    get_closest_keypoint_index,
-    get_height_of_bbox,
-    measure_xy_distance,
-    get_center_of_bbox,
-    measure_distance
+    get_centers_of_bboxes,
+    get_foot_positions,
+    measure_distance_sq
 )
+from functools import lru_cache
+
+@lru_cache(maxsize=8)
+def get_court_drawing_key_points(court_start_x, court_start_y, court_end_x, court_drawing_width):
+    # (14,2) array of (x,y) points; some coordinates are fractional.
+    # It only depends on the court position, so MiniCourts of same-sized videos share one read-only array
+    drawing_key_points = np.zeros((14, 2))
+
+    # Only these four court distances are needed, convert each to pixels once
+    half_court_height_pixels = convert_meters_to_pixel_distance(constants.HALF_COURT_LINE_HEIGHT*2, constants.DOUBLE_LINE_WIDTH, court_drawing_width)
+    double_ally_pixels = convert_meters_to_pixel_distance(constants.DOUBLE_ALLY_DIFFERENCE, constants.DOUBLE_LINE_WIDTH, court_drawing_width)
+    no_mans_land_pixels = convert_meters_to_pixel_distance(constants.NO_MANS_LAND_HEIGHT, constants.DOUBLE_LINE_WIDTH, court_drawing_width)
+    single_line_pixels = convert_meters_to_pixel_distance(constants.SINGLE_LINE_WIDTH, constants.DOUBLE_LINE_WIDTH, court_drawing_width)
+
+    # point 0 
+    drawing_key_points[0] = int(court_start_x), int(court_start_y)
+    # point 1
+    drawing_key_points[1] = int(court_end_x), int(court_start_y)
+    # point 2
+    drawing_key_points[2] = int(court_start_x), court_start_y + half_court_height_pixels
+    # point 3
+    drawing_key_points[3] = drawing_key_points[0,0] + court_drawing_width, drawing_key_points[2,1]
+    # #point 4
+    drawing_key_points[4] = drawing_key_points[0,0] + double_ally_pixels, drawing_key_points[0,1]
+    # #point 5
+    drawing_key_points[5] = drawing_key_points[2,0] + double_ally_pixels, drawing_key_points[2,1]
+    # #point 6
+    drawing_key_points[6] = drawing_key_points[1,0] - double_ally_pixels, drawing_key_points[1,1]
+    # #point 7
+    drawing_key_points[7] = drawing_key_points[3,0] - double_ally_pixels, drawing_key_points[3,1]
+    # #point 8
+    drawing_key_points[8] = drawing_key_points[4,0], drawing_key_points[4,1] + no_mans_land_pixels
+    # # #point 9
+    drawing_key_points[9] = drawing_key_points[8,0] + single_line_pixels, drawing_key_points[8,1]
+    # #point 10
+    drawing_key_points[10] = drawing_key_points[5,0], drawing_key_points[5,1] - no_mans_land_pixels
+    # # #point 11
+    drawing_key_points[11] = drawing_key_points[10,0] + single_line_pixels, drawing_key_points[10,1]
+    # # #point 12
+    drawing_key_points[12] = int((drawing_key_points[8,0] + drawing_key_points[9,0])/2), drawing_key_points[8,1]
+    # # #point 13
+    drawing_key_points[13] = int((drawing_key_points[10,0] + drawing_key_points[11,0])/2), drawing_key_points[10,1]
+
+    drawing_key_points.flags.writeable = False
+    return drawing_key_points
 
 class MiniCourt():
+    lines = (
+        (0, 2),
+        (4, 5),
+        (6,7),
+        (1,3),
+        
+        (0,1),
+        (8,9),
+        (10,11),
+        (2,3)
+    )
+
     def __init__(self,frame):
         self.drawing_rectangle_width = 250
         self.drawing_rectangle_height = 500
@@ -24,7 +78,7 @@ class MiniCourt():
         self.set_canvas_background_box_position(frame)
         self.set_mini_court_position()
         self.set_court_drawing_key_points()
-        self.set_court_lines()
+        self.set_court_overlay()
 
 
     def convert_meters_to_pixels(self, meters):
@@ -34,64 +88,7 @@ class MiniCourt():
                                             )
 
     def set_court_drawing_key_points(self):
-        drawing_key_points = [0]*28
-
-        # point 0 
-        drawing_key_points[0] , drawing_key_points[1] = int(self.court_start_x), int(self.court_start_y)
-        # point 1
-        drawing_key_points[2] , drawing_key_points[3] = int(self.court_end_x), int(self.court_start_y)
-        # point 2
-        drawing_key_points[4] = int(self.court_start_x)
-        drawing_key_points[5] = self.court_start_y + self.convert_meters_to_pixels(constants.HALF_COURT_LINE_HEIGHT*2)
-        # point 3
-        drawing_key_points[6] = drawing_key_points[0] + self.court_drawing_width
-        drawing_key_points[7] = drawing_key_points[5] 
-        # #point 4
-        drawing_key_points[8] = drawing_key_points[0] +  self.convert_meters_to_pixels(constants.DOUBLE_ALLY_DIFFERENCE)
-        drawing_key_points[9] = drawing_key_points[1] 
-        # #point 5
-        drawing_key_points[10] = drawing_key_points[4] + self.convert_meters_to_pixels(constants.DOUBLE_ALLY_DIFFERENCE)
-        drawing_key_points[11] = drawing_key_points[5] 
-        # #point 6
-        drawing_key_points[12] = drawing_key_points[2] - self.convert_meters_to_pixels(constants.DOUBLE_ALLY_DIFFERENCE)
-        drawing_key_points[13] = drawing_key_points[3] 
-        # #point 7
-        drawing_key_points[14] = drawing_key_points[6] - self.convert_meters_to_pixels(constants.DOUBLE_ALLY_DIFFERENCE)
-        drawing_key_points[15] = drawing_key_points[7] 
-        # #point 8
-        drawing_key_points[16] = drawing_key_points[8] 
-        drawing_key_points[17] = drawing_key_points[9] + self.convert_meters_to_pixels(constants.NO_MANS_LAND_HEIGHT)
-        # # #point 9
-        drawing_key_points[18] = drawing_key_points[16] + self.convert_meters_to_pixels(constants.SINGLE_LINE_WIDTH)
-        drawing_key_points[19] = drawing_key_points[17] 
-        # #point 10
-        drawing_key_points[20] = drawing_key_points[10] 
-        drawing_key_points[21] = drawing_key_points[11] - self.convert_meters_to_pixels(constants.NO_MANS_LAND_HEIGHT)
-        # # #point 11
-        drawing_key_points[22] = drawing_key_points[20] +  self.convert_meters_to_pixels(constants.SINGLE_LINE_WIDTH)
-        drawing_key_points[23] = drawing_key_points[21] 
-        # # #point 12
-        drawing_key_points[24] = int((drawing_key_points[16] + drawing_key_points[18])/2)
-        drawing_key_points[25] = drawing_key_points[17] 
-        # # #point 13
-        drawing_key_points[26] = int((drawing_key_points[20] + drawing_key_points[22])/2)
-        drawing_key_points[27] = drawing_key_points[21] 
-
-        self.drawing_key_points=drawing_key_points
-
-    def set_court_lines(self):
-        self.lines = [
-            (0, 2),
-            (4, 5),
-            (6,7),
-            (1,3),
-            
-            (0,1),
-            (8,9),
-            (10,11),
-            (10,11),
-            (2,3)
-        ]
+        self.drawing_key_points = get_court_drawing_key_points(self.court_start_x, self.court_start_y, self.court_end_x, self.court_drawing_width)
 
     def set_mini_court_position(self):
         self.court_start_x = self.start_x + self.padding_court
@@ -101,50 +98,59 @@ class MiniCourt():
         self.court_drawing_width = self.court_end_x - self.court_start_x
 
     def set_canvas_background_box_position(self,frame):
-        frame= frame.copy()
-
         self.end_x = frame.shape[1] - self.buffer
         self.end_y = self.buffer + self.drawing_rectangle_height
         self.start_x = self.end_x - self.drawing_rectangle_width
         self.start_y = self.end_y - self.drawing_rectangle_height
 
-    def draw_court(self,frame):
-        for i in range(0, len(self.drawing_key_points),2):
-            x = int(self.drawing_key_points[i])
-            y = int(self.drawing_key_points[i+1])
-            cv2.circle(frame, (x,y),5, (0,0,255),-1)
-
-        # draw Lines
-        for line in self.lines:
-            start_point = (int(self.drawing_key_points[line[0]*2]), int(self.drawing_key_points[line[0]*2+1]))
-            end_point = (int(self.drawing_key_points[line[1]*2]), int(self.drawing_key_points[line[1]*2+1]))
-            cv2.line(frame, start_point, end_point, (0, 0, 0), 2)
+    def set_court_overlay(self):
+        # The court never changes, so it is drawn once into an image the size of the background box,
+        # with a mask of the pixels it covers
+        origin = (self.start_x, self.start_y)
+        size = (self.end_y - self.start_y + 1, self.end_x - self.start_x + 1)
+        self.court_overlay = self.draw_court(np.zeros(size + (3,), np.uint8), origin)
+        self.court_overlay_mask = self.draw_court(np.zeros(size, np.uint8), origin, color=255).astype(bool)
+        self.background_box = np.full(size + (3,), 255, np.uint8)
+
+    def draw_court(self,frame, origin=(0,0), color=None):
+        # origin is the frame position of frame[0,0]; color draws everything in one color (used for masks)
+        key_points = (self.drawing_key_points.astype(int) - origin).tolist()
+        for x, y in key_points:
+            cv2.circle(frame, (x,y),5, (0,0,255) if color is None else color,-1)
+
+        # draw Lines, all segments in one call
+        line_segments = np.array([[key_points[start], key_points[end]] for start, end in self.lines], np.int32)
+        cv2.polylines(frame, line_segments, False, (0, 0, 0) if color is None else color, 2)
 
         # Draw net
-        net_start_point = (self.drawing_key_points[0], int((self.drawing_key_points[1] + self.drawing_key_points[5])/2))
-        net_end_point = (self.drawing_key_points[2], int((self.drawing_key_points[1] + self.drawing_key_points[5])/2))
-        cv2.line(frame, net_start_point, net_end_point, (255, 0, 0), 2)
+        net_y = int((self.drawing_key_points[0,1] + self.drawing_key_points[2,1])/2) - origin[1]
+        net_start_point = (key_points[0][0], net_y)
+        net_end_point = (key_points[1][0], net_y)
+        cv2.line(frame, net_start_point, net_end_point, (255, 0, 0) if color is None else color, 2)
 
         return frame
 
     def draw_background_rectangle(self,frame):
-        shapes = np.zeros_like(frame,np.uint8)
-        # Draw the rectangle
-        cv2.rectangle(shapes, (self.start_x, self.start_y), (self.end_x, self.end_y), (255, 255, 255), cv2.FILLED)
-        out = frame.copy()
+        # Blend only the box with white, in place; the rectangle end point is inclusive
+        box = frame[self.start_y:self.end_y+1, self.start_x:self.end_x+1]
         alpha=0.5
-        mask = shapes.astype(bool)
-        out[mask] = cv2.addWeighted(frame, alpha, shapes, 1 - alpha, 0)[mask]
+        cv2.addWeighted(box, alpha, self.background_box, 1 - alpha, 0, box)
 
-        return out
+        return frame
+
+    def draw_mini_court_on_frame(self,frame):
+        frame = self.draw_background_rectangle(frame)
+        # Copy the pre-drawn court over the box
+        box = frame[self.start_y:self.end_y+1, self.start_x:self.end_x+1]
+        np.copyto(box, self.court_overlay, where=self.court_overlay_mask[:,:,None])
+        return frame
 
-    def draw_mini_court(self,frames):
-        output_frames = []
-        for frame in frames:
-            frame = self.draw_background_rectangle(frame)
-            frame = self.draw_court(frame)
-            output_frames.append(frame)
-        return output_frames
+    def render(self,frame, player_positions, ball_positions):
+        # Everything the mini court adds to a frame: box, court, players and ball
+        frame = self.draw_mini_court_on_frame(frame)
+        frame = self.draw_points_on_frame(frame, player_positions)
+        frame = self.draw_points_on_frame(frame, ball_positions, color=(0,255,255))
+        return frame
 
     def get_start_point_of_mini_court(self):
         return (self.court_start_x,self.court_start_y)
@@ -154,99 +160,83 @@ class MiniCourt():
         return self.drawing_key_points
 
     def get_mini_court_coordinates(self,
+                                   *,
                                    object_position,
                                    closest_key_point, 
                                    closest_key_point_index, 
                                    player_height_in_pixels,
                                    player_height_in_meters
                                    ):
-        
-        distance_from_keypoint_x_pixels, distance_from_keypoint_y_pixels = measure_xy_distance(object_position, closest_key_point)
-
-        # Conver pixel distance to meters
-        distance_from_keypoint_x_meters = convert_pixel_distance_to_meters(distance_from_keypoint_x_pixels,
-                                                                           player_height_in_meters,
-                                                                           player_height_in_pixels
-                                                                           )
-        distance_from_keypoint_y_meters = convert_pixel_distance_to_meters(distance_from_keypoint_y_pixels,
-                                                                                player_height_in_meters,
-                                                                                player_height_in_pixels
-                                                                          )
-        
+        # Positions are (...,2) arrays of points, the heights broadcast over the leading dimensions.
+        # Keyword-only: the arguments are all same-shaped arrays, so a swapped pair would go unnoticed
+        distance_from_keypoint_pixels = np.abs(object_position - closest_key_point)
+
+        # Frame pixels -> meters (player height as reference) -> mini court pixels, folded into one scale per object
+        mini_court_pixels_per_pixel = self.convert_meters_to_pixels(np.expand_dims(player_height_in_meters, -1)) / np.expand_dims(player_height_in_pixels, -1)
+        mini_court_distance_pixels = distance_from_keypoint_pixels * mini_court_pixels_per_pixel
+
         # Convert to mini court coordinates
-        mini_court_x_distance_pixels = self.convert_meters_to_pixels(distance_from_keypoint_x_meters)
-        mini_court_y_distance_pixels = self.convert_meters_to_pixels(distance_from_keypoint_y_meters)
-        closest_mini_coourt_keypoint = ( self.drawing_key_points[closest_key_point_index*2],
-                                        self.drawing_key_points[closest_key_point_index*2+1]
-                                        )
-        
-        mini_court_player_position = (closest_mini_coourt_keypoint[0]+mini_court_x_distance_pixels,
-                                      closest_mini_coourt_keypoint[1]+mini_court_y_distance_pixels
-                                        )
+        closest_mini_court_keypoint = self.drawing_key_points[closest_key_point_index]
 
-        return  mini_court_player_position
+        return closest_mini_court_keypoint + mini_court_distance_pixels
 
     def convert_bounding_boxes_to_mini_court_coordinates(self,player_boxes, ball_boxes, original_court_key_points ):
         player_heights = {
             1: constants.PLAYER_1_HEIGHT_METERS,
             2: constants.PLAYER_2_HEIGHT_METERS
         }
-
-        output_player_boxes= []
-        output_ball_boxes= []
-
-        for frame_num, player_bbox in enumerate(player_boxes):
-            ball_box = ball_boxes[frame_num][1]
-            ball_position = get_center_of_bbox(ball_box)
-            closest_player_id_to_ball = min(player_bbox.keys(), key=lambda x: measure_distance(ball_position, get_center_of_bbox(player_bbox[x])))
-
-            output_player_bboxes_dict = {}
-            for player_id, bbox in player_bbox.items():
-                foot_position = get_foot_position(bbox)
-
-                # Get The closest keypoint in pixels
-                closest_key_point_index = get_closest_keypoint_index(foot_position,original_court_key_points, [0,2,12,13])
-                closest_key_point = (original_court_key_points[closest_key_point_index*2], 
-                                     original_court_key_points[closest_key_point_index*2+1])
-
-                # Get Player height in pixels
-                frame_index_min = max(0, frame_num-20)
-                frame_index_max = min(len(player_boxes), frame_num+50)
-                bboxes_heights_in_pixels = [get_height_of_bbox(player_boxes[i][player_id]) for i in range (frame_index_min,frame_index_max)]
-                max_player_height_in_pixels = max(bboxes_heights_in_pixels)
-
-                mini_court_player_position = self.get_mini_court_coordinates(foot_position,
-                                                                            closest_key_point, 
-                                                                            closest_key_point_index, 
-                                                                            max_player_height_in_pixels,
-                                                                            player_heights[player_id]
-                                                                            )
-                
-                output_player_bboxes_dict[player_id] = mini_court_player_position
-
-                if closest_player_id_to_ball == player_id:
-                    # Get The closest keypoint in pixels
-                    closest_key_point_index = get_closest_keypoint_index(ball_position,original_court_key_points, [0,2,12,13])
-                    closest_key_point = (original_court_key_points[closest_key_point_index*2], 
-                                        original_court_key_points[closest_key_point_index*2+1])
-                    
-                    mini_court_player_position = self.get_mini_court_coordinates(ball_position,
-                                                                            closest_key_point, 
-                                                                            closest_key_point_index, 
-                                                                            max_player_height_in_pixels,
-                                                                            player_heights[player_id]
-                                                                            )
-                    output_ball_boxes.append({1:mini_court_player_position})
-            output_player_boxes.append(output_player_bboxes_dict)
-
-        return output_player_boxes , output_ball_boxes
+        # (14,2) float32 like the keypoint model output, also when a list is passed in
+        original_court_key_points = np.asarray(original_court_key_points, dtype=np.float32).reshape(-1, 2)
+        key_point_indices = np.array([0,2,12,13])
+
+        # player_boxes maps player id -> (F,4) boxes and ball_boxes is (F,4); missing boxes are nan
+        player_ids = list(player_boxes.keys())
+        player_bboxes = np.stack([player_boxes[player_id] for player_id in player_ids], axis=1)
+        player_detected = ~np.isnan(player_bboxes[:,:,0])
+        number_of_frames = len(ball_boxes)
+
+        foot_positions = get_foot_positions(player_bboxes)
+        player_centers = get_centers_of_bboxes(player_bboxes)
+        ball_positions = get_centers_of_bboxes(ball_boxes)
+
+        # The ball is placed relative to the player closest to it
+        ball_distances = np.where(player_detected, measure_distance_sq(player_centers, ball_positions[:,None,:]), np.inf)
+        closest_player_to_ball = np.argmin(ball_distances, axis=1)
+
+        # Get the closest keypoint in pixels for every foot and the ball in one argmin, measured along y only
+        key_point_ys = original_court_key_points[key_point_indices, 1]
+        object_ys = np.concatenate([foot_positions[:,:,1], ball_positions[:,1,None]], axis=1)
+        closest_key_point_indices = key_point_indices[np.argmin(np.abs(object_ys[:,:,None] - key_point_ys), axis=-1)]
+        closest_key_points = original_court_key_points[closest_key_point_indices]
+
+        # Get Player height in pixels: the tallest box in [frame-20, frame+50); edge padding keeps the window inside the video
+        player_heights_in_pixels = player_bboxes[:,:,3] - player_bboxes[:,:,1]
+        padded_heights = np.pad(player_heights_in_pixels, ((20, 49), (0, 0)), mode='edge')
+        max_player_heights_in_pixels = np.fmax.reduce(sliding_window_view(padded_heights, 70, axis=0), axis=-1)
+
+        player_heights_in_meters = np.array([player_heights[player_id] for player_id in player_ids])
+        mini_court_player_positions = self.get_mini_court_coordinates(object_position=foot_positions,
+                                                                      closest_key_point=closest_key_points[:,:-1],
+                                                                      closest_key_point_index=closest_key_point_indices[:,:-1],
+                                                                      player_height_in_pixels=max_player_heights_in_pixels,
+                                                                      player_height_in_meters=player_heights_in_meters
+                                                                      )
+        mini_court_ball_positions = self.get_mini_court_coordinates(object_position=ball_positions,
+                                                                    closest_key_point=closest_key_points[:,-1],
+                                                                    closest_key_point_index=closest_key_point_indices[:,-1],
+                                                                    player_height_in_pixels=max_player_heights_in_pixels[np.arange(number_of_frames), closest_player_to_ball],
+                                                                    player_height_in_meters=player_heights_in_meters[closest_player_to_ball]
+                                                                    )
+
+        # (F,P,2) player positions in player_boxes order, nan where the player was not detected, and (F,2) ball positions
+        mini_court_player_positions[~player_detected] = np.nan
+
+        return mini_court_player_positions , mini_court_ball_positions
     
-    def draw_points_on_mini_court(self,frames,postions, color=(0,255,0)):
-        for frame_num, frame in enumerate(frames):
-            for _, position in postions[frame_num].items():
-                x,y = position
-                x= int(x)
-                y= int(y)
-                cv2.circle(frame, (x,y), 5, color, -1)
-        return frames
+    def draw_points_on_frame(self,frame,positions, color=(0,255,0)):
+        # positions is one (x,y) point or an (N,2) array of them; nan points were not detected
+        positions = np.reshape(positions, (-1, 2))
+        for x, y in positions[~np.isnan(positions[:,0])].astype(int).tolist():
+            cv2.circle(frame, (x,y), 5, color, -1)
+        return frame
 
@@ -1,97 +1,81 @@
-from ultralytics import YOLO 
 import cv2
-import pickle
-import pandas as pd
-
-class BallTracker:
-    def __init__(self,model_path):
-        self.model = YOLO(model_path)
+import numpy as np
+import sys
+sys.path.append('../')
+from utils import YoloDetector, get_track_bboxes
 
+class BallTracker(YoloDetector):
     def interpolate_ball_positions(self, ball_positions):
-        ball_positions = [x.get(1,[]) for x in ball_positions]
-        # convert the list into pandas dataframe
-        df_ball_positions = pd.DataFrame(ball_positions,columns=['x1','y1','x2','y2'])
-
-        # interpolate the missing values
-        df_ball_positions = df_ball_positions.interpolate()
-        df_ball_positions = df_ball_positions.bfill()
+        # (F,4) array of ball boxes with the frames where the ball was missed filled in
+        ball_positions = get_track_bboxes(ball_positions, 1)
+        detected = ~np.isnan(ball_positions[:,0])
+        if not detected.any():
+            return ball_positions
 
-        ball_positions = [{1:x} for x in df_ball_positions.to_numpy().tolist()]
+        # interpolate the missing values, holding the first/last detection at the ends
+        frame_nums = np.arange(len(ball_positions))
+        for column in range(4):
+            ball_positions[:,column] = np.interp(frame_nums, frame_nums[detected], ball_positions[detected,column])
 
         return ball_positions
 
     def get_ball_shot_frames(self,ball_positions):
-        ball_positions = [x.get(1,[]) for x in ball_positions]
-        # convert the list into pandas dataframe
-        df_ball_positions = pd.DataFrame(ball_positions,columns=['x1','y1','x2','y2'])
-
-        df_ball_positions['ball_hit'] = 0
-
-        df_ball_positions['mid_y'] = (df_ball_positions['y1'] + df_ball_positions['y2'])/2
-        df_ball_positions['mid_y_rolling_mean'] = df_ball_positions['mid_y'].rolling(window=5, min_periods=1, center=False).mean()
-        df_ball_positions['delta_y'] = df_ball_positions['mid_y_rolling_mean'].diff()
+        ball_positions = np.asarray(ball_positions, dtype=float).reshape(-1, 4)
+        mid_y = (ball_positions[:,1] + ball_positions[:,3])/2
         minimum_change_frames_for_hit = 25
-        for i in range(1,len(df_ball_positions)- int(minimum_change_frames_for_hit*1.2) ):
-            negative_position_change = df_ball_positions['delta_y'].iloc[i] >0 and df_ball_positions['delta_y'].iloc[i+1] <0
-            positive_position_change = df_ball_positions['delta_y'].iloc[i] <0 and df_ball_positions['delta_y'].iloc[i+1] >0
-
-            if negative_position_change or positive_position_change:
-                change_count = 0 
-                for change_frame in range(i+1, i+int(minimum_change_frames_for_hit*1.2)+1):
-                    negative_position_change_following_frame = df_ball_positions['delta_y'].iloc[i] >0 and df_ball_positions['delta_y'].iloc[change_frame] <0
-                    positive_position_change_following_frame = df_ball_positions['delta_y'].iloc[i] <0 and df_ball_positions['delta_y'].iloc[change_frame] >0
-
-                    if negative_position_change and negative_position_change_following_frame:
-                        change_count+=1
-                    elif positive_position_change and positive_position_change_following_frame:
-                        change_count+=1
-            
-                if change_count>minimum_change_frames_for_hit-1:
-                    df_ball_positions['ball_hit'].iloc[i] = 1
-
-        frame_nums_with_ball_hits = df_ball_positions[df_ball_positions['ball_hit']==1].index.tolist()
+        lookahead_frames = int(minimum_change_frames_for_hit*1.2)
+        if len(mid_y) <= lookahead_frames + 1:
+            return []
+
+        # Trailing mean over the last 5 frames (at least 1), nan frames are left out like pandas rolling(5, min_periods=1)
+        detected = ~np.isnan(mid_y)
+        window = np.ones(5)
+        window_sums = np.convolve(np.where(detected, mid_y, 0), window)[:len(mid_y)]
+        window_counts = np.convolve(detected, window)[:len(mid_y)]
+        with np.errstate(invalid='ignore'):
+            mid_y_rolling_mean = window_sums / window_counts
+        delta_y = np.diff(mid_y_rolling_mean, prepend=np.nan)
+
+        # A hit is a frame where the ball's vertical direction flips and stays flipped for most of the following frames
+        frame_nums = np.arange(1, len(delta_y) - lookahead_frames)
+        current_delta_y = delta_y[frame_nums]
+        next_delta_y = delta_y[frame_nums+1]
+
+        # Running counts of falling/rising frames before each index, so counting a window is one subtraction
+        falling_frames = np.concatenate([[0], np.cumsum(delta_y < 0)])
+        rising_frames = np.concatenate([[0], np.cumsum(delta_y > 0)])
+        window_start, window_end = frame_nums+1, frame_nums+lookahead_frames+1
+
+        negative_position_change = (current_delta_y > 0) & (next_delta_y < 0)
+        positive_position_change = (current_delta_y < 0) & (next_delta_y > 0)
+        change_count = np.where(negative_position_change, falling_frames[window_end] - falling_frames[window_start], 0) + \
+                       np.where(positive_position_change, rising_frames[window_end] - rising_frames[window_start], 0)
+
+        frame_nums_with_ball_hits = frame_nums[change_count > minimum_change_frames_for_hit-1].tolist()
 
         return frame_nums_with_ball_hits
 
-    def detect_frames(self,frames, read_from_stub=False, stub_path=None):
-        ball_detections = []
+    def run_model(self,batch):
+        return self.model.predict(batch, conf=0.15, half=self.half, verbose=False)
 
-        if read_from_stub and stub_path is not None:
-            with open(stub_path, 'rb') as f:
-                ball_detections = pickle.load(f)
-            return ball_detections
-
-        for frame in frames:
-            player_dict = self.detect_frame(frame)
-            ball_detections.append(player_dict)
-        
-        if stub_path is not None:
-            with open(stub_path, 'wb') as f:
-                pickle.dump(ball_detections, f)
-        
-        return ball_detections
-
-    def detect_frame(self,frame):
-        results = self.model.predict(frame,conf=0.15)[0]
+    def get_detection_dict(self,results, scale=1):
+        return self.get_ball_dict(results, scale)
 
+    def get_ball_dict(self,results, scale=1):
+        # scale maps xyxy boxes on the model input back to frame pixels
         ball_dict = {}
         for box in results.boxes:
-            result = box.xyxy.tolist()[0]
+            result = (np.array(box.xyxy.tolist()[0]) * scale).tolist()
             ball_dict[1] = result
         
         return ball_dict
 
-    def draw_bboxes(self,video_frames, player_detections):
-        output_video_frames = []
-        for frame, ball_dict in zip(video_frames, player_detections):
-            # Draw Bounding Boxes
-            for track_id, bbox in ball_dict.items():
-                x1, y1, x2, y2 = bbox
-                cv2.putText(frame, f"Ball ID: {track_id}",(int(bbox[0]),int(bbox[1] -10 )),cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 255, 255), 2)
-                cv2.rectangle(frame, (int(x1), int(y1)), (int(x2), int(y2)), (0, 255, 255), 2)
-            output_video_frames.append(frame)
-        
-        return output_video_frames
+    def draw_bbox_on_frame(self,frame, bbox):
+        # Draw Bounding Box; bbox is a whole-pixel int array
+        x1, y1, x2, y2 = bbox.tolist()
+        cv2.putText(frame, "Ball ID: 1",(x1, y1-10),cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 255, 255), 2)
+        cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 255), 2)
+        return frame
 
 
     
\ No newline at end of file
@@ -1,14 +1,10 @@
-from ultralytics import YOLO 
 import cv2
-import pickle
+import numpy as np
 import sys
 sys.path.append('../')
-from utils import measure_distance, get_center_of_bbox
-
-class PlayerTracker:
-    def __init__(self,model_path):
-        self.model = YOLO(model_path)
+from utils import YoloDetector, get_centers_of_bboxes, get_bbox_corners, measure_distance_sq
 
+class PlayerTracker(YoloDetector):
     def choose_and_filter_players(self, court_keypoints, player_detections):
         player_detections_first_frame = player_detections[0]
         chosen_player = self.choose_players(court_keypoints, player_detections_first_frame)
@@ -19,51 +15,31 @@ class PlayerTracker:
         return filtered_player_detections
 
     def choose_players(self, court_keypoints, player_dict):
-        distances = []
-        for track_id, bbox in player_dict.items():
-            player_center = get_center_of_bbox(bbox)
-
-            min_distance = float('inf')
-            for i in range(0,len(court_keypoints),2):
-                court_keypoint = (court_keypoints[i], court_keypoints[i+1])
-                distance = measure_distance(player_center, court_keypoint)
-                if distance < min_distance:
-                    min_distance = distance
-            distances.append((track_id, min_distance))
-        
-        # sorrt the distances in ascending order
-        distances.sort(key = lambda x: x[1])
-        # Choose the first 2 tracks
-        chosen_players = [distances[0][0], distances[1][0]]
-        return chosen_players
+        track_ids = list(player_dict.keys())
+        player_centers = get_centers_of_bboxes(np.reshape(list(player_dict.values()), (-1, 4)))
 
+        # distance of every player to the closest court keypoint, court_keypoints is (K,2); squared distances sort the same way
+        min_distances = measure_distance_sq(player_centers[:, None, :], court_keypoints[None, :, :]).min(axis=1)
 
-    def detect_frames(self,frames, read_from_stub=False, stub_path=None):
-        player_detections = []
+        # Choose the first 2 tracks, ties keep the detection order
+        chosen_players = [track_ids[i] for i in np.argsort(min_distances, kind='stable')[:2]]
+        return chosen_players
 
-        if read_from_stub and stub_path is not None:
-            with open(stub_path, 'rb') as f:
-                player_detections = pickle.load(f)
-            return player_detections
+    def run_model(self,batch):
+        # persist keeps the track ids across batches
+        return self.model.track(batch, persist=True, half=self.half, verbose=False)
 
-        for frame in frames:
-            player_dict = self.detect_frame(frame)
-            player_detections.append(player_dict)
-        
-        if stub_path is not None:
-            with open(stub_path, 'wb') as f:
-                pickle.dump(player_detections, f)
-        
-        return player_detections
+    def get_detection_dict(self,results, scale=1):
+        return self.get_player_dict(results, scale)
 
-    def detect_frame(self,frame):
-        results = self.model.track(frame, persist=True)[0]
+    def get_player_dict(self,results, scale=1):
+        # scale maps xyxy boxes on the model input back to frame pixels
         id_name_dict = results.names
 
         player_dict = {}
         for box in results.boxes:
             track_id = int(box.id.tolist()[0])
-            result = box.xyxy.tolist()[0]
+            result = (np.array(box.xyxy.tolist()[0]) * scale).tolist()
             object_cls_id = box.cls.tolist()[0]
             object_cls_name = id_name_dict[object_cls_id]
             if object_cls_name == "person":
@@ -71,17 +47,13 @@ class PlayerTracker:
         
         return player_dict
 
-    def draw_bboxes(self,video_frames, player_detections):
-        output_video_frames = []
-        for frame, player_dict in zip(video_frames, player_detections):
-            # Draw Bounding Boxes
-            for track_id, bbox in player_dict.items():
-                x1, y1, x2, y2 = bbox
-                cv2.putText(frame, f"Player ID: {track_id}",(int(bbox[0]),int(bbox[1] -10 )),cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 0, 255), 2)
-                cv2.rectangle(frame, (int(x1), int(y1)), (int(x2), int(y2)), (0, 0, 255), 2)
-            output_video_frames.append(frame)
-        
-        return output_video_frames
+    def draw_bboxes_on_frame(self,frame, track_ids, bboxes):
+        # Draw Bounding Boxes; bboxes is an (N,4) int array of whole-pixel boxes, one per track id.
+        # All boxes in one polylines call, only the labels need one call each
+        cv2.polylines(frame, get_bbox_corners(bboxes), True, (0, 0, 255), 2)
+        for track_id, (x1, y1) in zip(track_ids, bboxes[:, :2].tolist()):
+            cv2.putText(frame, f"Player ID: {track_id}",(x1, y1-10),cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 0, 255), 2)
+        return frame
 
 
     
\ No newline at end of file
@@ -1,4 +1,7 @@
-from .video_utils import read_video, save_video
-from .bbox_utils import get_center_of_bbox, measure_distance, get_foot_position,get_closest_keypoint_index,get_height_of_bbox,measure_xy_distance,get_center_of_bbox
-from .conversions import convert_pixel_distance_to_meters, convert_meters_to_pixel_distance
-from .player_stats_drawer_utils import draw_player_stats
\ No newline at end of file
+from .video_utils import read_video, read_video_av, read_keyframes, read_video_cuda, read_video_tensor, has_cuda_video_decoder, save_video, get_key_frames, preprocess_for_model, process_video_threaded
+from .bbox_utils import get_center_of_bbox, measure_distance, measure_distance_sq, get_foot_position,get_closest_keypoint_index,get_height_of_bbox,measure_xy_distance,get_track_bboxes,get_bbox_corners,get_centers_of_bboxes,get_foot_positions,get_ious
+from .conversions import convert_pixel_distance_to_meters, convert_meters_to_pixel_distance, convert_pixel_distance_to_meters_array, convert_meters_to_pixel_distance_array, Scale
+from .player_stats_drawer_utils import draw_player_stats_on_frame
+from .pipeline_utils import iter_queue, iter_batches, put_item, run_stages, prefetch, PipelineStopped
+from .stub_utils import save_detections_stub, load_detections_stub
+from .model_utils import load_yolo_model, get_yolo_engine, use_half, export_yolo_engine, write_calibration_data, PinnedBatchUploader, YoloDetector
\ No newline at end of file
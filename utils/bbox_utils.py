@@ -1,32 +1,66 @@
+import math
+import numpy as np
+
 def get_center_of_bbox(bbox):
     x1, y1, x2, y2 = bbox
     center_x = int((x1 + x2) / 2)
     center_y = int((y1 + y2) / 2)
     return (center_x, center_y)
-def measure_distance(p1,p2):
-    return ((p1[0]-p2[0])**2 + (p1[1]-p2[1])**2)**0.5
+# math.dist does the whole subtract/square/sqrt in C, ~4x faster per call than the Python expression
+measure_distance = math.dist
 def get_foot_position(bbox):
     x1, y1, x2, y2 = bbox
     return (int((x1 + x2) / 2), y2)
 
 def get_closest_keypoint_index(point, keypoints, keypoint_indices):
-   closest_distance = float('inf')
-   key_point_ind = keypoint_indices[0]
-   for keypoint_indix in keypoint_indices:
-       keypoint = keypoints[keypoint_indix*2], keypoints[keypoint_indix*2+1]
-       distance = abs(point[1]-keypoint[1])
-
-       if distance<closest_distance:
-           closest_distance = distance
-           key_point_ind = keypoint_indix
-    
-   return key_point_ind
+    # Closest of the keypoint_indices along y only; ties go to the first one.
+    # keypoints is (K,2) or the flat [x0,y0,x1,y1,...] layout of the keypoint model
+    keypoint_indices = np.asarray(keypoint_indices)
+    keypoints = np.asarray(keypoints).reshape(-1, 2)
+    return keypoint_indices[np.argmin(np.abs(point[1] - keypoints[keypoint_indices, 1]))]
 
 def get_height_of_bbox(bbox):
     return bbox[3]-bbox[1]
 
+def measure_distance_sq(p1,p2):
+    # Squared distance between points or (...,2) arrays of points; enough wherever distances are only compared
+    offsets = np.subtract(p1, p2)
+    return (offsets*offsets).sum(-1)
+
 def measure_xy_distance(p1,p2):
     return abs(p1[0]-p2[0]), abs(p1[1]-p2[1])
 
-def get_center_of_bbox(bbox):
-    return (int((bbox[0]+bbox[2])/2),int((bbox[1]+bbox[3])/2))
\ No newline at end of file
+def get_centers_of_bboxes(bboxes):
+    # get_center_of_bbox for a (...,4) array of boxes at once, cut to whole pixels the same way
+    bboxes = np.asarray(bboxes, dtype=float)
+    return np.trunc((bboxes[...,0:2] + bboxes[...,2:4])/2)
+
+def get_foot_positions(bboxes):
+    # get_foot_position for a (...,4) array of boxes at once
+    bboxes = np.asarray(bboxes, dtype=float)
+    return np.stack([np.trunc((bboxes[...,0] + bboxes[...,2])/2), bboxes[...,3]], axis=-1)
+
+def get_bbox_corners(bboxes):
+    # (N,4,2) int32 corners of (N,4) xyxy boxes, in the order cv2.rectangle draws them, for one cv2.polylines call
+    bboxes = np.asarray(bboxes, dtype=np.int32).reshape(-1, 4)
+    return bboxes[:, [[0,1],[2,1],[2,3],[0,3]]]
+
+def get_ious(bboxes_a, bboxes_b):
+    # (N,M) intersection over union of every pair of (N,4) and (M,4) xyxy boxes
+    bboxes_a = np.asarray(bboxes_a, dtype=float).reshape(-1, 1, 4)
+    bboxes_b = np.asarray(bboxes_b, dtype=float).reshape(1, -1, 4)
+    widths = (np.minimum(bboxes_a[...,2], bboxes_b[...,2]) - np.maximum(bboxes_a[...,0], bboxes_b[...,0])).clip(0)
+    heights = (np.minimum(bboxes_a[...,3], bboxes_b[...,3]) - np.maximum(bboxes_a[...,1], bboxes_b[...,1])).clip(0)
+    intersections = widths * heights
+    areas_a = (bboxes_a[...,2] - bboxes_a[...,0]) * (bboxes_a[...,3] - bboxes_a[...,1])
+    areas_b = (bboxes_b[...,2] - bboxes_b[...,0]) * (bboxes_b[...,3] - bboxes_b[...,1])
+    unions = areas_a + areas_b - intersections
+    return np.divide(intersections, unions, out=np.zeros_like(intersections), where=unions > 0)
+
+def get_track_bboxes(detections, track_id):
+    # (F,4) array of one track's boxes over all frames, nan where it was not detected
+    bboxes = np.full((len(detections), 4), np.nan)
+    for frame_num, detection in enumerate(detections):
+        if track_id in detection:
+            bboxes[frame_num] = detection[track_id]
+    return bboxes
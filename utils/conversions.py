@@ -1,6 +1,28 @@
+import numpy as np
 
 def convert_pixel_distance_to_meters(pixel_distance, refrence_height_in_meters, refrence_height_in_pixels):
     return (pixel_distance * refrence_height_in_meters) / refrence_height_in_pixels
 
 def convert_meters_to_pixel_distance(meters, refrence_height_in_meters, refrence_height_in_pixels):
-    return (meters * refrence_height_in_pixels) / refrence_height_in_meters
\ No newline at end of file
+    return (meters * refrence_height_in_pixels) / refrence_height_in_meters
+
+class Scale:
+    # Pixel <-> meter conversion for one reference length; both ratios are computed once, so converting is one multiply
+    __slots__ = ('meters_per_pixel', 'pixels_per_meter')
+
+    def __init__(self, refrence_height_in_meters, refrence_height_in_pixels):
+        self.meters_per_pixel = refrence_height_in_meters / refrence_height_in_pixels
+        self.pixels_per_meter = refrence_height_in_pixels / refrence_height_in_meters
+
+    def to_meters(self, pixel_distances):
+        return np.multiply(pixel_distances, self.meters_per_pixel)
+
+    def to_pixels(self, meters):
+        return np.multiply(meters, self.pixels_per_meter)
+
+# Array versions: one multiply by a ratio computed once, for distances of whole trajectories at a time
+def convert_pixel_distance_to_meters_array(pixel_distances, refrence_height_in_meters, refrence_height_in_pixels):
+    return Scale(refrence_height_in_meters, refrence_height_in_pixels).to_meters(pixel_distances)
+
+def convert_meters_to_pixel_distance_array(meters, refrence_height_in_meters, refrence_height_in_pixels):
+    return Scale(refrence_height_in_meters, refrence_height_in_pixels).to_pixels(meters)
@@ -0,0 +1,175 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+import shutil
+import tempfile
+import warnings
+from itertools import islice
+import cv2
+import numpy as np
+import torch
+from ultralytics import YOLO
+from .video_utils import read_video, preprocess_for_model, get_key_frames
+from .pipeline_utils import iter_batches
+from .stub_utils import save_detections_stub, load_detections_stub
+
+def use_half():
+    # FP16 inference on GPUs with tensor cores (compute capability 7.0+); older GPUs gain little from it
+    return torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 7
+
+def export_yolo_engine(model_path, batch_size, int8_data=None):
+    # TensorRT engine of the weights, written next to them; FP16 on GPUs with tensor cores.
+    # dynamic: the last batch of a video is usually smaller, and frames are only padded to the stride.
+    # With int8_data (a dataset yaml, see write_calibration_data) the engine is INT8, calibrated on those images
+    if int8_data is not None:
+        return YOLO(model_path).export(format='engine', int8=True, data=int8_data, dynamic=True, batch=batch_size, workspace=4, verbose=False)
+    return YOLO(model_path).export(format='engine', half=use_half(), dynamic=True, batch=batch_size, workspace=4, verbose=False)
+
+def write_calibration_data(video_path, names, output_dir, stride=60, max_frames=500):
+    # INT8 calibration set for export_yolo_engine: every stride-th frame of the video (at most max_frames) as images,
+    # and the dataset yaml pointing at them. Calibration only needs the images, names are the model's classes
+    image_dir = os.path.join(output_dir, 'images')
+    os.makedirs(image_dir, exist_ok=True)
+    for frame_num, frame in enumerate(islice(read_video(video_path, stride=stride), max_frames)):
+        cv2.imwrite(os.path.join(image_dir, f'{frame_num:05d}.jpg'), frame)
+
+    data_path = os.path.join(output_dir, 'data.yaml')
+    with open(data_path, 'w') as f:
+        f.write(f"path: {os.path.abspath(output_dir)}\ntrain: images\nval: images\nnames:\n")
+        for class_id, name in names.items():
+            f.write(f"  {class_id}: {name}\n")
+    return data_path
+
+def get_yolo_engine(model_path, batch_size):
+    # Path of the TensorRT engine of the weights, exported on the first run (or ahead of time with export_engine.py) and
+    # reused after that; it is built for up to batch_size frames at the training input size.
+    # Without CUDA, or when the export fails, the PyTorch weights are returned instead; an engine path is returned as is,
+    # so a broken engine fails when it is loaded instead of silently running the weights
+    if model_path.endswith('.engine') or not torch.cuda.is_available():
+        return model_path
+
+    engine_path = os.path.splitext(model_path)[0] + '.engine'
+    if not os.path.exists(engine_path):
+        try:
+            # Exported from a copy of the weights in a temporary directory and moved into place in one step, so a
+            # process starting meanwhile never loads a half-written engine
+            weights_path = YOLO(model_path).ckpt_path
+            with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(engine_path))) as export_dir:
+                export_weights_path = os.path.join(export_dir, os.path.basename(weights_path))
+                shutil.copyfile(weights_path, export_weights_path)
+                os.replace(export_yolo_engine(export_weights_path, batch_size), engine_path)
+        except Exception as e:
+            warnings.warn(f"TensorRT export of {model_path} failed, using the PyTorch model: {e!r}")
+            return model_path
+    return engine_path
+
+def load_yolo_model(model_path, batch_size):
+    # On the GPU, run a TensorRT engine of the weights instead of the PyTorch model (see get_yolo_engine)
+    engine_path = get_yolo_engine(model_path, batch_size)
+    return YOLO(engine_path, task='detect') if engine_path.endswith('.engine') else YOLO(engine_path)
+
+class PinnedBatchUploader:
+    # Copies uint8 (B,3,H,W) batches to the device through two page-locked host buffers used in turn.
+    # Pinned memory lets the copy run asynchronously, and alternating buffers means a buffer is never refilled
+    # while the previous batch may still be uploading from it
+    def __init__(self, device):
+        self.device = device
+        self.buffers = [None, None]
+        self.next_buffer = 0
+
+    def upload(self, images):
+        if self.device == 'cpu':
+            return torch.from_numpy(images)
+        buffer = self.buffers[self.next_buffer]
+        if buffer is None or buffer.shape[1:] != images.shape[1:] or len(buffer) < len(images):
+            buffer = torch.empty(images.shape, dtype=torch.uint8, pin_memory=True)
+            self.buffers[self.next_buffer] = buffer
+        self.next_buffer = 1 - self.next_buffer
+
+        # The last batch of a video is usually smaller and uses the front of the buffer
+        staging = buffer[:len(images)]
+        np.copyto(staging.numpy(), images)
+        return staging.to(self.device, non_blocking=True)
+
+class YoloDetector:
+    # What the player and ball trackers share: lazy model loading, batched detection of preprocessed frames and the
+    # static-frame gate. Subclasses run the model on a batch (run_model) and turn a frame's Results into its
+    # detection dict (get_detection_dict)
+    def __init__(self,model_path, batch_size=16, static_threshold=None):
+        # The model (and its TensorRT engine, exported on first use) is only loaded when frames are detected,
+        # so runs that read the detections from a stub never pay for it
+        self.model_path = model_path
+        self.model = None
+        # Frames per forward pass in detect_frames
+        self.batch_size = batch_size
+        self.half = use_half()
+        # Frames that barely change from the last detected one reuse its detection; None detects every frame
+        self.static_threshold = static_threshold
+        self.last_thumbnail = None
+        self.last_detection = {}
+        # Frames are preprocessed to the training input size on a thread pool (cv2 releases the GIL) and handed to YOLO as tensors
+        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.imgsz = None
+        self.preprocess_pool = ThreadPoolExecutor(max_workers=4)
+        self.uploader = PinnedBatchUploader(self.device)
+
+    def run_model(self,batch):
+        raise NotImplementedError
+
+    def get_detection_dict(self,results, scale=1):
+        raise NotImplementedError
+
+    def detect_frames(self,frames, read_from_stub=False, stub_path=None):
+        detections = []
+
+        if read_from_stub and stub_path is not None:
+            return load_detections_stub(stub_path)
+
+        # frames can be any iterable, e.g. a video generator; only one batch is held at a time
+        for batch in iter_batches(frames, self.batch_size):
+            detections.extend(self.detect_batch(batch))
+
+        if stub_path is not None:
+            save_detections_stub(detections, stub_path)
+
+        return detections
+
+    def detect_frame(self,frame):
+        return self.detect_batch([frame])[0]
+
+    def detect_batch(self,frames):
+        self.load_model()
+        if self.static_threshold is None:
+            key_frames = [True] * len(frames)
+        else:
+            key_frames, self.last_thumbnail = get_key_frames(frames, self.static_threshold, self.last_thumbnail)
+        key_frame_images = [frame for frame, is_key in zip(frames, key_frames) if is_key]
+
+        # One forward pass for the key frames of the batch; the results are still handled in frame order
+        model_inputs = list(self.preprocess_pool.map(preprocess_for_model, key_frame_images, repeat(self.imgsz)))
+        scales = [scale for _, scale in model_inputs]
+        results = iter(zip(self.run_model(self.to_model_batch(model_inputs)), scales)) if model_inputs else iter([])
+        detections = []
+        for is_key in key_frames:
+            if is_key:
+                self.last_detection = self.get_detection_dict(*next(results))
+            detections.append(self.last_detection)
+        return detections
+
+    def warmup(self,frame):
+        self.load_model()
+        # One full batch at the video's input shape, so CUDA/cuDNN setup and kernel selection happen before detection starts.
+        # predict rather than track, so no tracker state is created
+        model_inputs = [preprocess_for_model(frame, self.imgsz)] * self.batch_size
+        self.model.predict(self.to_model_batch(model_inputs), half=self.half, verbose=False)
+
+    def load_model(self):
+        if self.model is None:
+            self.model = load_yolo_model(self.model_path, self.batch_size)
+            self.imgsz = self.model.overrides.get('imgsz', 640)
+
+    def to_model_batch(self,model_inputs):
+        # (B,3,H,W) RGB in [0,1], what YOLO's own preprocessing produces, so predict/track run the model on it directly
+        # Uploaded as uint8 and converted on the device, a quarter of the bytes of a float32 copy; scaled in place
+        batch = self.uploader.upload(np.stack([image for image, _ in model_inputs]))
+        return (batch.half() if self.half else batch.float()).div_(255)
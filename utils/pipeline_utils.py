@@ -0,0 +1,100 @@
+import threading
+from queue import Queue, Empty, Full
+
+
+class PipelineStopped(Exception):
+    # Raised in a stage waiting on a queue once another stage of run_stages has failed
+    pass
+
+def put_item(output_queue, item, stop=None):
+    # Queue.put that gives up once stop is set, so a stage never blocks on a queue nobody reads anymore
+    while True:
+        if stop is not None and stop.is_set():
+            raise PipelineStopped()
+        try:
+            output_queue.put(item, timeout=None if stop is None else 0.1)
+            return
+        except Full:
+            pass
+
+def iter_queue(input_queue, stop=None):
+    # Yield items until the producing stage sends the None sentinel, or until stop is set
+    while True:
+        if stop is not None and stop.is_set():
+            raise PipelineStopped()
+        try:
+            item = input_queue.get(timeout=None if stop is None else 0.1)
+        except Empty:
+            continue
+        if item is None:
+            return
+        yield item
+
+def iter_batches(items, batch_size):
+    # Lists of up to batch_size items from any iterable, so generators never have to be materialized
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def prefetch(items, size):
+    # Iterates items on a background thread, up to size items ahead of the caller; errors are raised in the caller
+    item_queue = Queue(maxsize=size)
+    stop = threading.Event()
+    errors = []
+
+    def produce():
+        try:
+            for item in items:
+                if stop.is_set():
+                    break
+                item_queue.put(item)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            item_queue.put(None)
+
+    threading.Thread(target=produce, daemon=True).start()
+    finished = False
+    try:
+        yield from iter_queue(item_queue)
+        finished = True
+        if errors:
+            raise errors[0]
+    finally:
+        if not finished:
+            # The caller stopped early: let the producer see stop instead of blocking on a full queue
+            stop.set()
+            while item_queue.get() is not None:
+                pass
+
+def run_stages(*stages, stop=None):
+    # Runs every (target, args) stage on its own thread and raises the first error.
+    # A failed stage would leave its neighbours blocked on a queue: with stop (a threading.Event the stages pass to
+    # put_item/iter_queue) it is set on the first error, and the other stages are waited for while they unwind, so
+    # e.g. a writer gets to finalize its file. Without stop the first error is raised right away
+    errors = []
+
+    def run_stage(target, args):
+        try:
+            target(*args)
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run_stage, args=stage, daemon=True) for stage in stages]
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.1)
+            if errors:
+                if stop is None:
+                    raise errors[0]
+                stop.set()
+    if errors:
+        raise errors[0]
@@ -0,0 +1,18 @@
+import numpy as np
+
+def save_detections_stub(detections, stub_path):
+    # One row per box: frame number, track id and the xyxy box as float32 (what YOLO returns).
+    # zlib-compressed; the columns are small and compress well, so loading is not slowed down
+    rows = [(frame_num, track_id, bbox) for frame_num, detection in enumerate(detections) for track_id, bbox in detection.items()]
+    np.savez_compressed(stub_path,
+                        number_of_frames=np.int32(len(detections)),
+                        frame_nums=np.array([row[0] for row in rows], dtype=np.int32),
+                        track_ids=np.array([row[1] for row in rows], dtype=np.int32),
+                        bboxes=np.array([row[2] for row in rows], dtype=np.float32).reshape(-1, 4))
+
+def load_detections_stub(stub_path):
+    with np.load(stub_path) as stub:
+        detections = [{} for _ in range(int(stub['number_of_frames']))]
+        for frame_num, track_id, bbox in zip(stub['frame_nums'].tolist(), stub['track_ids'].tolist(), stub['bboxes'].tolist()):
+            detections[frame_num][track_id] = bbox
+    return detections
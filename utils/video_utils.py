@@ -1,19 +1,290 @@
+import os
+import shutil
+import subprocess
+import threading
+from functools import lru_cache
 import cv2
+import numpy as np
+from queue import Queue
+from .pipeline_utils import iter_queue, put_item, run_stages, prefetch as prefetch_items
 
-def read_video(video_path):
+def read_video(video_path, stride=1, start=0, prefetch=8):
+    # Frames are decoded lazily, so only the frame being processed is held in memory; start skips to that frame first.
+    # With stride > 1 only every stride-th frame is returned; the others are only grabbed, skipping the conversion to BGR.
+    # stride='keyframes' returns only the key frames (see read_keyframes), always from the start of the video.
+    # Decoding runs up to prefetch frames ahead on a background thread (OpenCV releases the GIL while decoding), so it
+    # overlaps with the caller's work; prefetch=0 decodes on the caller's thread
+    if stride == 'keyframes':
+        if start:
+            raise ValueError("start is not supported with stride='keyframes'")
+        frames = read_keyframes(video_path)
+    else:
+        frames = decode_video(video_path, stride, start)
+    if prefetch:
+        frames = prefetch_items(frames, prefetch)
+    yield from frames
+
+def decode_video(video_path, stride=1, start=0):
     cap = cv2.VideoCapture(video_path)
-    frames = []
+    try:
+        if start:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+        frame_num = 0
+        while cap.grab():
+            if frame_num % stride == 0:
+                ret, frame = cap.retrieve()
+                if not ret:
+                    break
+                yield frame
+            frame_num += 1
+    finally:
+        # Also runs when the caller stops early, e.g. next(read_video(path)) for the first frame
+        cap.release()
+
+def read_video_av(video_path):
+    # read_video with PyAV (optional dependency): libavcodec decodes with frame and slice threads across all cores,
+    # and libswscale converts each frame to BGR
+    import av
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        stream.thread_type = 'AUTO'
+        for frame in container.decode(stream):
+            yield frame.to_ndarray(format='bgr24')
+
+def read_keyframes(video_path):
+    # Only the key frames (I/IDR) of the video, e.g. for passes that need a frame every second or so.
+    # The decoder skips every other frame, so this is far less work than decoding the whole video; needs PyAV
+    import av
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        stream.codec_context.skip_frame = 'NONKEY'
+        for frame in container.decode(stream):
+            yield frame.to_ndarray(format='bgr24')
+
+def has_cuda_video_decoder():
+    # OpenCV built with CUDA and the NVIDIA Video Codec SDK, and a GPU to run it on
+    return hasattr(cv2, 'cudacodec') and cv2.cuda.getCudaEnabledDeviceCount() > 0
+
+def read_video_cuda(video_path):
+    # read_video with NVDEC: frames are decoded on the GPU and yielded as BGR cv2.cuda_GpuMat, without a copy to the host.
+    # Only for consumers that work on GpuMats; check has_cuda_video_decoder() first
+    reader = cv2.cudacodec.createVideoReader(video_path)
+    reader.set(cv2.cudacodec.ColorFormat_BGR)
     while True:
-        ret, frame = cap.read()
+        ret, frame = reader.nextFrame()
         if not ret:
             break
-        frames.append(frame)
-    cap.release()
-    return frames
+        yield frame
+
+def read_video_tensor(video_path):
+    # The whole video as one (N,H,W,3) uint8 array, for passes that need random access to the frames; frames[i:i+B]
+    # is a batch without a copy. Each frame is decoded straight into its slot of the array, allocated once from the
+    # frame count of the container. That count is only an estimate for some containers: extra frames are appended
+    # and missing ones cut off. Streams and containers without a count (0 or negative) are read into a list and stacked
+    cap = cv2.VideoCapture(video_path)
+    try:
+        number_of_frames = max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), 0)
+        height, width = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        frames = np.empty((number_of_frames, height, width, 3), dtype=np.uint8)
+        frame_num = 0
+        while frame_num < number_of_frames:
+            slot = frames[frame_num]
+            ret, frame = cap.read(slot)
+            if not ret:
+                break
+            # OpenCV allocates a new array instead when the frame doesn't match the slot
+            if not np.shares_memory(frame, slot):
+                if frame.shape != slot.shape:
+                    raise ValueError(f"Frame {frame_num} of {video_path} is {frame.shape}, not {slot.shape} like the video")
+                slot[...] = frame
+            frame_num += 1
+        frames = frames[:frame_num]
+        if frame_num == number_of_frames:
+            extra_frames = []
+            while True:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                extra_frames.append(frame)
+            if extra_frames:
+                frames = np.concatenate([frames, np.stack(extra_frames)]) if len(frames) else np.stack(extra_frames)
+        return frames
+    finally:
+        cap.release()
+
+def preprocess_for_model(frame, imgsz, stride=32):
+    # YOLO's letterbox done up front: downscale so the longer side is imgsz, pad bottom/right to a multiple of stride,
+    # then BGR HWC -> RGB CHW. Padding only at the far edges leaves box coordinates unchanged.
+    # Also returns the xyxy factors that map boxes on the model input back to frame pixels
+    height, width = frame.shape[:2]
+    ratio = min(imgsz / height, imgsz / width, 1)
+    new_width, new_height = int(round(width * ratio)), int(round(height * ratio))
+    if ratio < 1:
+        frame = cv2.resize(frame, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+    # One strided copy does BGR -> RGB and HWC -> CHW into the padded image; only the padding is filled separately
+    image = np.empty((3, new_height + -new_height % stride, new_width + -new_width % stride), np.uint8)
+    image[:, :new_height, :new_width] = frame.transpose(2, 0, 1)[::-1]
+    image[:, new_height:, :] = 114
+    image[:, :new_height, new_width:] = 114
+    return image, np.array([width / new_width, height / new_height] * 2)
+
+def get_frame_thumbnail(frame, size=(64,36)):
+    # Small uint8 grayscale copy of the frame that is cheap to compare with other frames
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+
+def get_key_frames(frames, threshold, last_thumbnail=None):
+    # A frame is a key frame when its mean absolute difference (0-255) to the previous key frame is above threshold.
+    # Comparing with the last key frame rather than the previous frame keeps slow changes from adding up unseen
+    key_frames = []
+    for frame in frames:
+        thumbnail = get_frame_thumbnail(frame)
+        # L1 norm of the uint8 difference in one OpenCV call, no float copies
+        is_key = last_thumbnail is None or cv2.norm(thumbnail, last_thumbnail, cv2.NORM_L1) / thumbnail.size > threshold
+        if is_key:
+            last_thumbnail = thumbnail
+        key_frames.append(is_key)
+    return key_frames, last_thumbnail
+
+# H.264 encoders for the ffmpeg writer in order of preference, with their options
+FFMPEG_H264_ENCODERS = (
+    ('h264_nvenc', ('-preset', 'p1')),
+    ('libx264', ()),
+)
+
+@lru_cache(maxsize=None)
+def get_ffmpeg_h264_encoder():
+    # First of FFMPEG_H264_ENCODERS the installed ffmpeg can actually open (NVENC needs an NVIDIA GPU and driver,
+    # not only a build with it), checked once by encoding a single frame; None without ffmpeg
+    if shutil.which('ffmpeg') is None:
+        return None
+    for codec, options in FFMPEG_H264_ENCODERS:
+        probe = subprocess.run(['ffmpeg', '-loglevel', 'quiet', '-f', 'lavfi', '-i', 'color=size=256x256', '-frames:v', '1',
+                                '-c:v', codec, *options, '-f', 'null', '-'])
+        if probe.returncode == 0:
+            return codec, options
+    return None
+
+class FFmpegVideoWriter:
+    # Writes BGR frames like cv2.VideoWriter, but through a pipe to an ffmpeg process, which encodes on its own threads
+    # while the frames are still being produced
+    def __init__(self, output_video_path, frame_size, fps, codec, options=()):
+        width, height = frame_size
+        self.output_video_path = output_video_path
+        self.process = subprocess.Popen(['ffmpeg', '-y', '-loglevel', 'error',
+                                         '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-',
+                                         # yuv420p needs even sizes, odd ones get a row/column of padding
+                                         '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+                                         '-c:v', codec, *options, '-pix_fmt', 'yuv420p', output_video_path],
+                                        stdin=subprocess.PIPE)
+
+    def isOpened(self):
+        return self.process.poll() is None
+
+    def write(self, frames):
+        # One frame, or a whole (N,H,W,3) array of them in a single write; the pipe reads the array's memory directly
+        try:
+            self.process.stdin.write(np.ascontiguousarray(frames).data)
+        except BrokenPipeError:
+            # ffmpeg has exited
+            self.close_pipe()
+            self.raise_error(self.process.wait())
+
+    def release(self):
+        # Nothing left to report if a write already raised
+        if self.process.stdin.closed:
+            return
+        self.close_pipe()
+        returncode = self.process.wait()
+        if returncode != 0:
+            self.raise_error(returncode)
+
+    def close_pipe(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    def raise_error(self, returncode):
+        raise RuntimeError(f"ffmpeg failed to write {self.output_video_path} (exit code {returncode})")
+
+# OPENCV_FFMPEG_WRITER_OPTIONS is process-wide and read when a writer is opened, so writers are opened one at a time
+_writer_options_lock = threading.Lock()
+
+def open_video_writer(output_video_path, frame_size, fps=24):
+    # H.264 files are many times smaller than MJPG's intra-only frames: pipe the frames to ffmpeg when it is installed,
+    # else try OpenCV's FFmpeg backend with NVENC on the GPU, then its software H.264 encoder, and fall back to MJPG,
+    # which every OpenCV build can write
+    encoder = get_ffmpeg_h264_encoder()
+    if encoder is not None:
+        return FFmpegVideoWriter(output_video_path, frame_size, fps, *encoder)
+    with _writer_options_lock:
+        # The user's own options are put back afterwards; without any, the software encoder is tried as they are
+        user_options = os.environ.get('OPENCV_FFMPEG_WRITER_OPTIONS')
+        try:
+            for writer_options in ('video_codec;h264_nvenc', user_options):
+                if writer_options is None:
+                    os.environ.pop('OPENCV_FFMPEG_WRITER_OPTIONS', None)
+                else:
+                    os.environ['OPENCV_FFMPEG_WRITER_OPTIONS'] = writer_options
+                out = cv2.VideoWriter(output_video_path, cv2.CAP_FFMPEG, cv2.VideoWriter_fourcc(*'avc1'), fps, frame_size)
+                if out.isOpened():
+                    return out
+        finally:
+            if user_options is None:
+                os.environ.pop('OPENCV_FFMPEG_WRITER_OPTIONS', None)
+            else:
+                os.environ['OPENCV_FFMPEG_WRITER_OPTIONS'] = user_options
+    return cv2.VideoWriter(output_video_path, cv2.VideoWriter_fourcc(*'MJPG'), fps, frame_size)
 
 def save_video(output_video_frames, output_video_path):
-    fourcc = cv2.VideoWriter_fourcc(*'MJPG')
-    out = cv2.VideoWriter(output_video_path, fourcc, 24, (output_video_frames[0].shape[1], output_video_frames[0].shape[0]))
-    for frame in output_video_frames:
-        out.write(frame)
-    out.release()
\ No newline at end of file
+    # output_video_frames can be any iterable, or an (N,H,W,3) array like read_video_tensor's; the first frame sets the video size
+    if isinstance(output_video_frames, np.ndarray):
+        if len(output_video_frames) == 0:
+            return
+        out = open_video_writer(output_video_path, (output_video_frames.shape[2], output_video_frames.shape[1]))
+        try:
+            if isinstance(out, FFmpegVideoWriter):
+                # The whole video goes down the pipe in one write
+                out.write(output_video_frames)
+            else:
+                for frame in output_video_frames:
+                    out.write(frame)
+        finally:
+            out.release()
+        return
+
+    output_video_frames = iter(output_video_frames)
+    first_frame = next(output_video_frames, None)
+    if first_frame is None:
+        return
+    out = open_video_writer(output_video_path, (first_frame.shape[1], first_frame.shape[0]))
+    try:
+        out.write(first_frame)
+        for frame in output_video_frames:
+            out.write(frame)
+    finally:
+        out.release()
+
+def process_video_threaded(input_video_path, output_video_path, callback, prefetch=16):
+    # Decode -> callback(frame_num, frame) -> encode, each on its own thread with at most prefetch frames between two of them.
+    # If a stage fails the others stop too: the video is released and the frames written so far are finalized
+    read_queue = Queue(maxsize=prefetch)
+    write_queue = Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def read_frames():
+        # Already on its own thread
+        for frame in read_video(input_video_path, prefetch=0):
+            put_item(read_queue, frame, stop)
+        put_item(read_queue, None, stop)
+
+    def process_frames():
+        for frame_num, frame in enumerate(iter_queue(read_queue, stop)):
+            put_item(write_queue, callback(frame_num, frame), stop)
+        put_item(write_queue, None, stop)
+
+    def write_frames():
+        save_video(iter_queue(write_queue, stop), output_video_path)
+
+    run_stages((read_frames, ()), (process_frames, ()), (write_frames, ()), stop=stop)